@@ -6,15 +6,25 @@ Merge & Deduplicate Contacts (LLM-assisted via Ollama)
 
 Requirements:
   - Python 3
-  - pip install pandas requests
+  - pip install pandas aiohttp
+  - Optional: pip install pyarrow (faster CSV loading; falls back to pandas' C engine)
   - A local Ollama server running (http://localhost:11434) with model "llama3.1:8b" pulled:
       ollama pull llama3.1:8b
+  - Start the server with OLLAMA_NUM_PARALLEL set (e.g. OLLAMA_NUM_PARALLEL=4 ollama serve),
+    otherwise concurrent requests are still serialized server-side.
+
+Environment:
+  - OLLAMA_NUM_PARALLEL: max number of in-flight requests to Ollama (default 4).
+    Should match the server's own OLLAMA_NUM_PARALLEL.
 
 Behavior:
   - Reads all .csv files from ./input_contacts
   - Harmonizes column names (case-insensitive), ensuring "FullName" exists
   - Builds a normalized_name for duplicate grouping
-  - Sends duplicate groups to Ollama for intelligent merging
+  - Merges duplicate groups without conflicting values directly in Python
+  - Sends remaining duplicate groups to Ollama for intelligent merging (concurrently)
+  - Caches LLM responses in llm_cache.sqlite keyed by a hash of model + prompt
+    (pass --no-cache to bypass)
   - Falls back to original rows if LLM fails or response isn't valid JSON
   - Writes merged output to merged_contacts.csv (no index)
 """
@@ -24,11 +34,17 @@ import re
 import glob
 import json
 import time
+import asyncio
+import sqlite3
+import hashlib
+import argparse
 import traceback
-from typing import List, Dict, Any, Optional
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Dict, Any, Optional, Tuple
 
+import aiohttp
 import pandas as pd
-import requests
 
 # ---------------------------
 # Configuration
@@ -40,6 +56,18 @@ OLLAMA_ENDPOINT = "http://localhost:11434/api/generate"
 OLLAMA_MODEL = "llama3.1:8b"
 HTTP_TIMEOUT = 60  # seconds
 
+# On-disk cache of merged LLM responses (SHA-256 of model + prompt -> merged JSON)
+LLM_CACHE_FILE = "llm_cache.sqlite"
+
+# Max concurrent requests to Ollama; keep in sync with the server's OLLAMA_NUM_PARALLEL.
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+
+# Precompiled patterns
+_RE_PUNCT = re.compile(r"[^\w\s]", re.UNICODE)
+_RE_WS = re.compile(r"\s+")
+_RE_NON_DIGIT = re.compile(r"\D")
+_RE_FENCE = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL | re.IGNORECASE)
+
 # If you want to limit how many duplicate groups to process (for testing), set a small number here.
 MAX_GROUPS: Optional[int] = None  # None means process all
 
@@ -118,12 +146,47 @@ def normalize_name(name: Any) -> str:
         return ""
     s = name.strip().lower()
     # Replace punctuation with space
-    s = re.sub(r"[^\w\s]", " ", s, flags=re.UNICODE)
+    s = _RE_PUNCT.sub(" ", s)
     # Collapse whitespace
-    s = re.sub(r"\s+", " ", s).strip()
+    s = _RE_WS.sub(" ", s).strip()
     return s
 
 
+class JsonObjectTracker:
+    """
+    Incrementally track brace depth over streamed text (ignoring braces inside
+    JSON strings) to detect when the first top-level {...} object has closed.
+    """
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        # Offset just past the closing brace within the last chunk fed
+        self.end = -1
+
+    def feed(self, chunk: str) -> bool:
+        """Consume a chunk; return True once the first top-level object is complete."""
+        for i, ch in enumerate(chunk):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"' and self.depth > 0:
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.end = i + 1
+                    return True
+        return False
+
+
 def safe_json_loads(text: str) -> Optional[Dict[str, Any]]:
     """
     Try to parse a JSON object from text. Handles:
@@ -139,7 +202,7 @@ def safe_json_loads(text: str) -> Optional[Dict[str, Any]]:
         pass
 
     # 2) Strip code fences if present
-    fence_match = re.search(r"```(?:json)?\s*(\{.*?\})\s*```", text, flags=re.DOTALL | re.IGNORECASE)
+    fence_match = _RE_FENCE.search(text)
     if fence_match:
         inner = fence_match.group(1)
         try:
@@ -148,39 +211,79 @@ def safe_json_loads(text: str) -> Optional[Dict[str, Any]]:
             pass
 
     # 3) Find first plausible JSON object
-    # This is a heuristic: find the first top-level {...} block.
-    stack = []
-    start_idx = None
-    for i, ch in enumerate(text):
-        if ch == "{":
-            if not stack:
-                start_idx = i
-            stack.append("{")
-        elif ch == "}":
-            if stack:
-                stack.pop()
-                if not stack and start_idx is not None:
-                    candidate = text[start_idx:i + 1]
-                    try:
-                        return json.loads(candidate)
-                    except Exception:
-                        # continue scanning in case there's another valid block later
-                        start_idx = None
-                        continue
+    # Try decoding at each top-level '{'; raw_decode ignores any trailing commentary.
+    # On failure skip the whole balanced block, so a fragment nested inside a
+    # malformed object is never returned as the result.
+    decoder = json.JSONDecoder()
+    i = text.find("{")
+    while i != -1:
+        try:
+            obj, _ = decoder.raw_decode(text, i)
+            return obj
+        except json.JSONDecodeError:
+            tracker = JsonObjectTracker()
+            if not tracker.feed(text[i:]):
+                break  # unbalanced to the end of the text
+            i = text.find("{", i + tracker.end)
     # Not parseable
     return None
 
 
+def is_empty_value(v: Any) -> bool:
+    """True for None, NaN and blank strings."""
+    if v is None:
+        return True
+    if isinstance(v, float) and pd.isna(v):
+        return True
+    return isinstance(v, str) and not v.strip()
+
+
+def comparable_value(field: str, v: Any) -> str:
+    """Canonical form of a field value for conflict detection."""
+    s = str(v).strip()
+    f = field.lower()
+    if "email" in f:
+        return s.lower()
+    if any(t in f for t in ("phone", "mobile", "number", "fax")):
+        return _RE_NON_DIGIT.sub("", s)
+    return s
+
+
+def try_trivial_merge(rows: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], bool]:
+    """
+    Merge rows without the LLM when every field has at most one distinct non-empty value
+    (emails compared case-insensitively, phone numbers by digits only).
+    Returns (merged_row, conflict). merged_row is only meaningful when conflict is False.
+    """
+    merged: Dict[str, Any] = {}
+    seen: Dict[str, str] = {}
+    for r in rows:
+        for k, v in r.items():
+            if is_empty_value(v):
+                merged.setdefault(k, None)
+                continue
+            cv = comparable_value(k, v)
+            if k in seen:
+                if seen[k] != cv:
+                    return {}, True
+                continue
+            seen[k] = cv
+            merged[k] = v
+    return merged, False
+
+
 def build_prompt_for_group(rows: List[Dict[str, Any]]) -> str:
     """
     Build the deduplication prompt given a list of row dicts for the same normalized_name.
     The prompt instructs the LLM to return only a single merged JSON object.
     """
-    # Only include relevant keys (avoid the helper key)
-    cleaned_rows = []
-    for r in rows:
-        r = {k: (None if pd.isna(v) else v) for k, v in r.items() if k != "normalized_name"}
-        cleaned_rows.append(r)
+    # Only include relevant, non-empty fields (avoid the helper key) to keep the prompt small
+    cleaned_rows = [
+        {k: v for k, v in r.items() if k != "normalized_name" and not is_empty_value(v)}
+        for r in rows
+    ]
+    # Drop records that are identical after cleaning
+    cleaned_rows = list({json.dumps(r, sort_keys=True, ensure_ascii=False): r for r in cleaned_rows}.values())
 
     example_rules = (
         "You are an expert data deduplication assistant. I have the following contact records that might be for the same person. "
@@ -193,36 +296,109 @@ def build_prompt_for_group(rows: List[Dict[str, Any]]) -> str:
         "- Prefer consistent casing (e.g., emails lowercase, names in title case if appropriate).\n"
         "- Keep field names as-is from the input (do not invent new fields unless necessary to clarify a value).\n\n"
         "Here are the records to merge:\n"
-        f"{json.dumps(cleaned_rows, ensure_ascii=False, indent=2)}\n\n"
+        f"{json.dumps(cleaned_rows, ensure_ascii=False)}\n\n"
         "Please provide ONLY the merged JSON object as your response, with no other text or explanation."
     )
     return example_rules
 
 
-def call_ollama(prompt: str) -> Optional[Dict[str, Any]]:
+def open_cache(path: str) -> sqlite3.Connection:
+    """Open (creating if needed) the SQLite LLM response cache."""
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS cache(key TEXT PRIMARY KEY, value BLOB)")
+    conn.commit()
+    return conn
+
+
+def cache_key(prompt: str) -> str:
+    """Content-addressed cache key for a prompt sent to OLLAMA_MODEL."""
+    canonical = json.dumps({"model": OLLAMA_MODEL, "prompt": prompt}, sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def cache_get(conn: sqlite3.Connection, key: str) -> Optional[Dict[str, Any]]:
+    """Return the cached merged JSON for key, or None on a miss."""
+    row = conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    try:
+        return json.loads(row[0])
+    except Exception:
+        return None
+
+
+def cache_put(conn: sqlite3.Connection, key: str, value: Dict[str, Any]) -> None:
+    """Store a merged JSON object under key."""
+    conn.execute(
+        "INSERT OR REPLACE INTO cache(key, value) VALUES (?, ?)",
+        (key, json.dumps(value, ensure_ascii=False).encode("utf-8")),
+    )
+    conn.commit()
+
+
+async def call_ollama(
+    session: aiohttp.ClientSession,
+    prompt: str,
+    cache: Optional[sqlite3.Connection] = None,
+) -> Optional[Dict[str, Any]]:
     """
     Call the local Ollama API with the given prompt and return a parsed JSON object
     from the model's 'response' text. Returns None on failure.
+    If a cache connection is given, a previous response for the same prompt is reused.
     """
+    key = cache_key(prompt)
+    if cache is not None:
+        cached = cache_get(cache, key)
+        if cached is not None:
+            return cached
+
     payload = {
         "model": OLLAMA_MODEL,
         "prompt": prompt,
-        "stream": False,
+        "stream": True,
+        # Deterministic output so responses are safe to cache
+        "options": {"temperature": 0, "seed": 0},
     }
     try:
-        resp = requests.post(OLLAMA_ENDPOINT, json=payload, timeout=HTTP_TIMEOUT)
-        if resp.status_code != 200:
-            log(f"ERROR: Ollama returned status {resp.status_code}: {resp.text[:2000]}")
-            return None
-        data = resp.json()
-        # Ollama /api/generate returns {"model":..., "created_at":..., "response": "...", "done": true, ...}
-        text = data.get("response", "")
+        async with session.post(OLLAMA_ENDPOINT, json=payload) as resp:
+            if resp.status != 200:
+                body = await resp.text()
+                log(f"ERROR: Ollama returned status {resp.status}: {body[:2000]}")
+                return None
+            # Streaming /api/generate yields one JSON line per chunk: {"response": "...", "done": false, ...}
+            tracker = JsonObjectTracker()
+            parts: List[str] = []
+            async for line in resp.content:
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                piece = data.get("response", "")
+                parts.append(piece)
+                complete = False
+                rest = piece
+                while tracker.feed(rest):
+                    # A top-level {...} closed; stop only if it parses (prose like
+                    # "{not json}" may come before the real object)
+                    if isinstance(safe_json_loads("".join(parts)), dict):
+                        complete = True
+                        break
+                    rest = rest[tracker.end:]
+                    tracker = JsonObjectTracker()
+                if complete:
+                    # Drop the connection to stop generating trailing text
+                    resp.close()
+                    break
+                if data.get("done"):
+                    break
+        text = "".join(parts)
         merged = safe_json_loads(text)
         if merged is None:
             log("ERROR: LLM response was not valid JSON after multiple extraction attempts.")
+        elif cache is not None and isinstance(merged, dict):
+            cache_put(cache, key, merged)
         return merged
-    except requests.RequestException as e:
-        log(f"ERROR: Request to Ollama failed: {e}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        log(f"ERROR: Request to Ollama failed: {e!r}")
         return None
     except Exception as e:
         log(f"ERROR: Unexpected error calling Ollama: {e}")
@@ -230,10 +406,47 @@ def call_ollama(prompt: str) -> Optional[Dict[str, Any]]:
         return None
 
 
+async def merge_groups(
+    jobs: List[Tuple[str, int, str]],
+    cache: Optional[sqlite3.Connection] = None,
+) -> List[Optional[Dict[str, Any]]]:
+    """
+    Send (display_name, candidate_count, prompt) jobs to Ollama concurrently, with at most
+    OLLAMA_NUM_PARALLEL requests in flight. Results are returned in job order.
+    """
+    sem = asyncio.Semaphore(max(1, OLLAMA_NUM_PARALLEL))
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+
+    # One pooled keep-alive connection per parallel slot, reused across all groups
+    connector = aiohttp.TCPConnector(limit=max(1, OLLAMA_NUM_PARALLEL), keepalive_timeout=HTTP_TIMEOUT)
+
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        async def worker(display_name: str, count: int, prompt: str) -> Optional[Dict[str, Any]]:
+            async with sem:
+                log(f"Merging records for '{display_name}'... ({count} candidates)")
+                return await call_ollama(session, prompt, cache)
+
+        return await asyncio.gather(*[worker(*job) for job in jobs])
+
+
 # ---------------------------
 # Main pipeline
 # ---------------------------
 
+def read_csv_file(path: str) -> pd.DataFrame:
+    """
+    Read a single CSV as strings and standardize its columns.
+    Uses the PyArrow engine when available, falling back to the default C engine.
+    """
+    read_kwargs = dict(dtype=str, keep_default_na=False, na_values=["", "NA", "NaN"])
+    try:
+        df = pd.read_csv(path, engine="pyarrow", **read_kwargs)
+    except (ImportError, ValueError):
+        # PyArrow not installed, or an option/file it can't handle
+        df = pd.read_csv(path, **read_kwargs)
+    return standardize_columns(df)
+
+
 def load_all_csvs(input_dir: str) -> pd.DataFrame:
     """Load and concatenate all CSVs from the input directory, allowing different column orders."""
     pattern = os.path.join(input_dir, "*.csv")
@@ -242,15 +455,19 @@ def load_all_csvs(input_dir: str) -> pd.DataFrame:
         log(f"WARNING: No CSV files found in '{input_dir}'. Producing empty output.")
         return pd.DataFrame()
 
-    dfs = []
-    for p in paths:
-        try:
-            df = pd.read_csv(p, dtype=str, keep_default_na=False, na_values=["", "NA", "NaN"])
-            df = standardize_columns(df)
-            dfs.append(df)
-            log(f"Loaded: {p} with {len(df)} rows")
-        except Exception as e:
-            log(f"ERROR: Failed to read '{p}': {e}")
+    loaded: Dict[str, pd.DataFrame] = {}
+    with ThreadPoolExecutor(max_workers=min(8, len(paths))) as ex:
+        futures = {ex.submit(read_csv_file, p): p for p in paths}
+        for fut in as_completed(futures):
+            p = futures[fut]
+            try:
+                df = fut.result()
+                loaded[p] = df
+                log(f"Loaded: {p} with {len(df)} rows")
+            except Exception as e:
+                log(f"ERROR: Failed to read '{p}': {e}")
+    # Keep glob order regardless of completion order
+    dfs = [loaded[p] for p in paths if p in loaded]
     if not dfs:
         return pd.DataFrame()
     # Concatenate without sorting columns; differing columns will be unioned
@@ -267,56 +484,94 @@ def prepare_dataframe(master: pd.DataFrame) -> pd.DataFrame:
         # Ensure existence (already ensured in standardize_columns, but double-protect)
         master["FullName"] = ""
 
-    # Normalize names
-    master["normalized_name"] = master["FullName"].apply(normalize_name)
+    # Normalize names (vectorized equivalent of normalize_name).
+    # Keep passing the compiled `re` patterns: plain string patterns may be routed to
+    # pyarrow's RE2 engine, where \w is ASCII-only ("Osmeña" -> "osme a", CJK -> ""),
+    # so the result would no longer match normalize_name on Unicode names.
+    master["normalized_name"] = (
+        master["FullName"]
+        .fillna("")
+        .astype(str)
+        .str.lower()
+        .str.replace(_RE_PUNCT, " ", regex=True)
+        .str.replace(_RE_WS, " ", regex=True)
+        .str.strip()
+    )
 
     return master
 
 
-def process_duplicates(master: pd.DataFrame) -> pd.DataFrame:
+def process_duplicates(master: pd.DataFrame, use_cache: bool = True) -> pd.DataFrame:
     """
     Identify duplicate groups by normalized_name. For each group with >1 rows,
     call the LLM to merge; otherwise keep the single row. Returns a final DataFrame.
+    Set use_cache=False to ignore the on-disk LLM response cache.
     """
     if master is None or master.empty:
         log("Input is empty. Nothing to process.")
         return master
 
     # Identify duplicate groups (exclude empty normalized_name to avoid accidental merges)
-    grouped = master.groupby("normalized_name", dropna=False)
-    unique_rows = []
+    grouped = master.groupby("normalized_name", sort=False, dropna=False)
+    # Index labels of rows kept as-is; their dicts are only built while composing the output
+    unique_index: List[Any] = []
     merged_rows = []
 
     # Stats
-    dup_keys = [k for k, g in grouped if k and len(g) > 1]
-    log(f"Found {len(dup_keys)} potential duplicate groups to process...")
+    sizes = grouped.size()
+    n_dup = int(((sizes > 1) & (sizes.index != "")).sum())
+    log(f"Found {n_dup} potential duplicate groups to process...")
 
     processed_count = 0
+    trivial_count = 0
+    pending: List[Tuple[str, pd.Index]] = []
+    jobs: List[Tuple[str, int, str]] = []
 
     for key, group_df in grouped:
+        # Treat empty normalized_name as always unique (skip LLM)
+        if not key or len(group_df) == 1:
+            unique_index.extend(group_df.index)
+            continue
+
         rows = group_df.to_dict(orient="records")
 
-        # Treat empty normalized_name as always unique (skip LLM)
-        if not key or len(rows) == 1:
-            unique_rows.extend(rows)
+        # Groups without conflicting values don't need the LLM
+        merged, conflict = try_trivial_merge(rows)
+        if not conflict:
+            merged_rows.append(merged)
+            trivial_count += 1
             continue
 
         # Optional cap for testing
         if MAX_GROUPS is not None and processed_count >= MAX_GROUPS:
-            unique_rows.extend(rows)
+            unique_index.extend(group_df.index)
             continue
 
-        # Build and call LLM
         # Choose a nice display name for logs:
         display_name = rows[0].get("FullName", "") or key
-        log(f"Merging records for '{display_name}'... ({len(rows)} candidates)")
+        pending.append((display_name, group_df.index))
+        jobs.append((display_name, len(rows), build_prompt_for_group(rows)))
+        processed_count += 1
 
-        prompt = build_prompt_for_group(rows)
-        merged_json = call_ollama(prompt)
+    total_dups = trivial_count + len(jobs)
+    if total_dups:
+        log(f"Merged {trivial_count}/{total_dups} groups without the LLM "
+            f"({trivial_count / total_dups:.0%}); {len(jobs)} need LLM merging.")
+
+    # Call the LLM for all groups concurrently
+    results: List[Optional[Dict[str, Any]]] = []
+    if jobs:
+        cache = open_cache(LLM_CACHE_FILE) if use_cache else None
+        try:
+            results = asyncio.run(merge_groups(jobs, cache))
+        finally:
+            if cache is not None:
+                cache.close()
 
+    for (display_name, group_index), merged_json in zip(pending, results):
         if merged_json is None or not isinstance(merged_json, dict):
             log(f"LLM merge failed for '{display_name}'. Keeping original records for this group.")
-            unique_rows.extend(rows)
+            unique_index.extend(group_index)
             continue
 
         # Keep the merged JSON as one canonical row
@@ -329,11 +584,17 @@ def process_duplicates(master: pd.DataFrame) -> pd.DataFrame:
         merged_json["normalized_name"] = normalize_name(merged_fullname)
 
         merged_rows.append(merged_json)
-        processed_count += 1
+
+    def gen_unique():
+        cols = list(master.columns)
+        for values in master.loc[unique_index].itertuples(index=False, name=None):
+            yield dict(zip(cols, values))
 
     # Compose final DataFrame:
-    # Union of all columns across uniques + merges
-    final_df = pd.DataFrame(unique_rows + merged_rows)
+    # Union of all columns across uniques (master's columns) + merges,
+    # ordered by first appearance
+    all_cols = list(dict.fromkeys(chain(master.columns, (k for r in merged_rows for k in r))))
+    final_df = pd.DataFrame.from_records(chain(gen_unique(), merged_rows), columns=all_cols)
 
     # Ideally we remove helper column before saving
     if "normalized_name" in final_df.columns:
@@ -349,6 +610,11 @@ def process_duplicates(master: pd.DataFrame) -> pd.DataFrame:
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Merge & deduplicate contacts with Ollama.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help=f"Ignore the LLM response cache ({LLM_CACHE_FILE}).")
+    args = parser.parse_args()
+
     os.makedirs(INPUT_DIR, exist_ok=True)
 
     log("Loading CSV files...")
@@ -363,7 +629,7 @@ def main():
     log(f"Total loaded rows: {len(master)}")
     master = prepare_dataframe(master)
 
-    final_df = process_duplicates(master)
+    final_df = process_duplicates(master, use_cache=not args.no_cache)
 
     # Save output
     final_df.to_csv(OUTPUT_FILE, index=False)
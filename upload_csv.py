@@ -1,79 +1,167 @@
 #!/usr/bin/env python3
-import csv, sys
+import argparse
+import csv
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
+from itertools import islice
+import pandas as pd
 from google.cloud import firestore
 from google.oauth2 import service_account
 
 PROJECT_ID = "va-solutions-eadd3"
 SERVICE_ACCOUNT_FILE = "serviceAccount.json"
+CHUNK_SIZE = 500
+# Concurrent chunk uploads, each with its own default BulkWriter. Every writer
+# has its own limiter (500 ops/s by default), so the total write rate can reach
+# MAX_WORKERS * 500 ops/s on files with many chunks; lower this to write slower.
+MAX_WORKERS = 16
+MAX_WRITE_ATTEMPTS = 5  # per document, before the write is counted as failed
+
+# CSV columns joined (in order) into search_keywords
+KEYWORD_FIELDS = [
+    "FullName", "job_title", "department", "Company", "org_type", "Address",
+    "city", "country", "country_code", "inferred_seniority", "inferred_name_origin",
+    "inferred_region", "inferred_contact_tier", "network_cluster",
+    "suggested_next_action", "tag",
+]
+
+SEP = "\x1f"  # ASCII unit separator
+
+def chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk: return
+        yield chunk
 
 def parse_list(val):
     if not val: return []
     return [v.strip() for v in val.replace(";",",").split(",") if v.strip()]
 
-def build_search_keywords(row):
-    fields = [
-        row.get("FullName") or "",
-        row.get("job_title") or "",
-        row.get("department") or "",
-        row.get("Company") or "",
-        row.get("org_type") or "",
-        row.get("Address") or "",
-        row.get("city") or "",
-        row.get("country") or "",
-        row.get("country_code") or "",
-        row.get("inferred_seniority") or "",
-        row.get("inferred_name_origin") or "",
-        row.get("inferred_region") or "",
-        row.get("inferred_contact_tier") or "",
-        row.get("network_cluster") or "",
-        row.get("suggested_next_action") or "",
-        row.get("tag") or ""
-    ]
-    # Filter out any potential empty strings from the final list before joining
-    return " ".join(filter(None, fields)).lower()
+def column(df, name):
+    # Missing columns behave like empty cells
+    if name not in df.columns: return pd.Series("", index=df.index, dtype=object)
+    return df[name].fillna("")
+
+def build_search_keywords(df):
+    cols = [column(df, f) for f in KEYWORD_FIELDS]
+    # Join on a separator that never appears in contact data, then drop the runs left by
+    # empty fields; whitespace inside values is kept verbatim (as in index.html)
+    joined = cols[0].str.cat(cols[1:], sep=SEP)
+    joined = joined.str.replace(SEP + "+", SEP, regex=True).str.strip(SEP)
+    return joined.str.replace(SEP, " ", regex=False).str.lower()
+
+def build_docs(df):
+    now = datetime.utcnow()
+    text = lambda name: column(df, name).str.strip()
+    lists = lambda name: column(df, name).map(parse_list)
+    docs = pd.DataFrame({
+        "FullName": text("FullName"),
+        "job_title": text("job_title"),
+        "department": text("department"),
+        "company": text("Company"),
+        "org_type": text("org_type"),
+        "address": text("Address"),
+        "city": text("city"),
+        "country": text("country"),
+        "country_code": text("country_code"),
+        "office_number": lists("office_number"),
+        "mobile_number": lists("mobile_number"),
+        "fax_number": lists("fax_number"),
+        "email": lists("Email"),
+        "website": text("Website"),
+        "updated_at": text("updated_at").replace("", now.isoformat()),
+        "created_by": "",
+        "inferred_seniority": text("inferred_seniority"),
+        "inferred_name_origin": text("inferred_name_origin"),
+        "inferred_region": text("inferred_region"),
+        "inferred_contact_tier": text("inferred_contact_tier"),
+        "network_cluster": text("network_cluster"),
+        "suggested_next_action": text("suggested_next_action"),
+        "tag": text("tag"),
+        "search_keywords": build_search_keywords(df),
+    }, index=df.index)
+    return docs, now
+
+def read_docs(csv_file):
+    # csv.DictReader tolerates rows with more fields than the header (extras go
+    # under the None key and are ignored), which the bundled exports rely on
+    with open(csv_file, newline='', encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        for chunk in chunks(reader, CHUNK_SIZE):
+            df = pd.DataFrame.from_records(chunk, columns=reader.fieldnames)
+            yield build_docs(df)
+
+def write_chunk(db, docs, now):
+    # Runs on a worker thread; BulkWriter instances aren't shared between threads.
+    # Returns (written, failed) as reported by the writer's callbacks.
+    lock = threading.Lock()
+    counts = {"written": 0, "failed": 0}
+
+    def on_result(ref, result, writer):
+        with lock: counts["written"] += 1
+
+    def on_error(failure, writer):
+        # Retry a bounded number of times, then record the failure instead of
+        # letting BulkWriter's default handler drop it silently
+        if failure.attempts < MAX_WRITE_ATTEMPTS: return True
+        with lock: counts["failed"] += 1
+        print(f"ERROR: write to {failure.operation.reference.path} failed after "
+              f"{failure.attempts} attempts: {failure.message}")
+        return False
+
+    bw = db.bulk_writer()
+    bw.on_write_result(on_result)
+    bw.on_write_error(on_error)
+    contacts = db.collection("contacts")
+    for doc in docs:
+        doc["created_at"] = now
+        bw.create(contacts.document(), doc)
+    bw.close()
+    return counts["written"], counts["failed"]
 
 def upload_csv():
-    if len(sys.argv) < 2:
-        print("Usage: python upload_csv.py contacts.csv")
+    parser = argparse.ArgumentParser(description="Upload contacts from a CSV to Firestore.")
+    parser.add_argument("csv_file", help="CSV file to upload, e.g. contacts.csv")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Build the documents and report how many would be uploaded, without writing")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        total = sum(len(docs) for docs, _ in read_docs(args.csv_file))
+        print(f"Dry run: {total} contacts would be uploaded")
         return
-    csv_file = sys.argv[1]
 
     creds = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
     db = firestore.Client(project=PROJECT_ID, credentials=creds)
 
-    with open(csv_file, newline='', encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            doc = {
-                "FullName": (row.get("FullName") or "").strip(),
-                "job_title": (row.get("job_title") or "").strip(),
-                "department": (row.get("department") or "").strip(),
-                "company": (row.get("Company") or "").strip(),
-                "org_type": (row.get("org_type") or "").strip(),
-                "address": (row.get("Address") or "").strip(),
-                "city": (row.get("city") or "").strip(),
-                "country": (row.get("country") or "").strip(),
-                "country_code": (row.get("country_code") or "").strip(),
-                "office_number": parse_list(row.get("office_number")),
-                "mobile_number": parse_list(row.get("mobile_number")),
-                "fax_number": parse_list(row.get("fax_number")),
-                "email": parse_list(row.get("Email")),
-                "website": (row.get("Website") or "").strip(),
-                "updated_at": (row.get("updated_at") or "").strip() or datetime.utcnow().isoformat(),
-                "created_at": datetime.utcnow(),
-                "created_by": "",
-                "inferred_seniority": (row.get("inferred_seniority") or "").strip(),
-                "inferred_name_origin": (row.get("inferred_name_origin") or "").strip(),
-                "inferred_region": (row.get("inferred_region") or "").strip(),
-                "inferred_contact_tier": (row.get("inferred_contact_tier") or "").strip(),
-                "network_cluster": (row.get("network_cluster") or "").strip(),
-                "suggested_next_action": (row.get("suggested_next_action") or "").strip(),
-                "tag": (row.get("tag") or "").strip(),
-            }
-            doc["search_keywords"] = build_search_keywords(row)
-            db.collection("contacts").add(doc)
-            print(f"Uploaded {doc['FullName']}")
+    count = 0
+    failed = 0
+
+    def report(done):
+        nonlocal count, failed
+        for fut in done:
+            written, errors = fut.result()
+            count += written
+            failed += errors
+        print(f"Uploaded {count} contacts so far ({failed} failed)")
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        inflight = set()
+        for docs, now in read_docs(args.csv_file):
+            inflight.add(ex.submit(write_chunk, db, docs.to_dict(orient="records"), now))
+            # Bound queued chunks so memory stays flat on large files
+            if len(inflight) >= MAX_WORKERS:
+                done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                report(done)
+        if inflight:
+            report(wait(inflight).done)
+
+    print(f"Done. Uploaded {count} contacts, {failed} failed")
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     upload_csv()